@@ -4,16 +4,38 @@ Face Recognition System - Production Ready
 Offline ML-based face recognition with secure authentication
 """
 
-from flask import Flask, render_template, request, send_from_directory, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, send_from_directory, jsonify, session, redirect, url_for, Response
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+import json
+import mimetypes
+from urllib.parse import quote
+
+try:
+    import orjson  # C-extension JSON encoder; much faster than stdlib with indent
+except ImportError:
+    orjson = None
+
+try:
+    import faiss  # optional ANN library; exact IndexFlatIP used when present
+except ImportError:
+    faiss = None
 import os
 from datetime import datetime, timedelta
+import torch
+import torch.nn.functional as F
 import sqlite3
-import random
-import string
+import hmac
 from functools import wraps
-from PIL import Image, ImageEnhance
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
+import atexit
 import secrets
 from werkzeug.security import safe_join
 from dotenv import load_dotenv
@@ -45,15 +67,133 @@ app.config['SESSION_COOKIE_SECURE'] = os.getenv('FLASK_ENV') == 'production'  #
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
 
+# Server-side sessions
+# The cookie only carries a signed session id; the payload lives in a
+# sessions table with a per-worker in-memory cache in front, so session
+# lookups on the hot auth path are O(1) dict hits and the Set-Cookie
+# header stays small.
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session dict stored server-side under a signed id"""
+    def __init__(self, initial=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.modified = False
+
+class ServerSideSessionInterface(SessionInterface):
+    """Signed-cookie session id backed by SQLite with an in-memory cache"""
+
+    def __init__(self):
+        self._cache = {}  # sid -> (data dict, expires_at)
+        self._cache_lock = threading.Lock()
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='session-id', key_derivation='hmac')
+
+    def _load(self, sid):
+        now = time.time()
+        with self._cache_lock:
+            record = self._cache.get(sid)
+        if record is not None:
+            data, expires_at = record
+            if expires_at > now:
+                return dict(data)
+            with self._cache_lock:
+                self._cache.pop(sid, None)
+        cursor = get_db().execute(
+            'SELECT data, expires_at FROM sessions WHERE sid = ?', (sid,))
+        row = cursor.fetchone()
+        if row is None or row[1] <= now:
+            return None
+        data = json.loads(row[0])
+        with self._cache_lock:
+            self._cache[sid] = (data, row[1])
+        return dict(data)
+
+    def _store(self, sid, data, expires_at):
+        with self._cache_lock:
+            self._cache[sid] = (dict(data), expires_at)
+        conn = get_db()
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO sessions (sid, data, expires_at)
+                VALUES (?, ?, ?)
+            ''', (sid, json.dumps(data), expires_at))
+
+    def _delete(self, sid):
+        with self._cache_lock:
+            self._cache.pop(sid, None)
+        conn = get_db()
+        with conn:
+            conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self._load(sid)
+                if data is not None:
+                    return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32))
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        self._store(session.sid, dict(session), expires_at)
+        signed_sid = self._signer(app).sign(session.sid.encode('ascii')).decode('ascii')
+        response.set_cookie(
+            name, signed_sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain, path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+app.session_interface = ServerSideSessionInterface()
+
 # Environment configuration
 DEBUG_MODE = os.getenv('FLASK_ENV', 'development') == 'development'
 PORT = int(os.getenv('PORT', 5000))
 HOST = os.getenv('HOST', '127.0.0.1')
 
 # Reference database configuration
-REFERENCE_FOLDER = 'D:\\thirdeye\\thirdeye\\face_detection1\\project\\reference_database'
+REFERENCE_FOLDER = os.getenv('REFERENCE_FOLDER', os.path.join(PROJECT_ROOT, 'reference_database'))
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'face_sketch.db')
 
+# Checked once at startup instead of stat-ing the folder per request
+if not os.path.isdir(REFERENCE_FOLDER):
+    print(f'WARNING: Reference database folder not found: {REFERENCE_FOLDER}. '
+          'Add reference images to the "reference_database" folder.')
+
+# Image formats accepted in the reference database
+SUPPORTED_IMAGE_FORMATS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+# Offload file transfers to the reverse proxy when configured.
+# USE_X_SENDFILE makes send_from_directory emit an X-Sendfile header;
+# X_ACCEL_REFERENCE_PREFIX is an nginx 'internal' location (e.g.
+# '/_refs/') mapped to REFERENCE_FOLDER, served via X-Accel-Redirect so
+# the kernel's sendfile(2) moves the bytes instead of Python.
+app.use_x_sendfile = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+X_ACCEL_REFERENCE_PREFIX = os.getenv('X_ACCEL_REFERENCE_PREFIX', '')
+
 # Logging configuration
 if not DEBUG_MODE:
     # Production logging
@@ -65,7 +205,17 @@ if not DEBUG_MODE:
         '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
     ))
     file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+
+    # Request threads only enqueue records; disk writes and rotation run
+    # on the listener's background thread
+    _log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(_log_queue)
+    queue_handler.setLevel(logging.INFO)
+    app.logger.addHandler(queue_handler)
+    _log_listener = QueueListener(_log_queue, file_handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
     app.logger.setLevel(logging.INFO)
     app.logger.info('Face Recognition App startup')
 else:
@@ -83,28 +233,330 @@ def set_security_headers(response):
         response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
     return response
 
-# CLIP model will be loaded on first use (lazy loading)
+# CLIP model is loaded once per worker; gunicorn pre-warms it in the
+# post_fork hook so the first request never stalls on the load
 clip_model = None
 clip_preprocess = None
 device = None
+clip_input_dtype = None
+_clip_load_lock = threading.Lock()
 
 def load_clip_model():
-    """Load CLIP model on demand with error handling"""
-    global clip_model, clip_preprocess, device
+    """Load CLIP model (thread-safe, idempotent) with error handling"""
+    global clip_model, clip_preprocess, device, clip_input_dtype
     if clip_model is None:
+        with _clip_load_lock:
+            if clip_model is not None:
+                return clip_model, clip_preprocess, device
+            try:
+                app.logger.info('[LOADING] Loading CLIP model...')
+                start_time = time.perf_counter()
+                # clip stays a lazy import: it's heavy and only needed
+                # once the model actually loads
+                import clip
+                device = "cuda" if torch.cuda.is_available() else "cpu"
+                model, clip_preprocess = clip.load("ViT-B/32", device=device)
+                if device == 'cuda':
+                    # Half precision halves weight bandwidth and enables
+                    # tensor-core GEMMs; keep FP32 on CPU where FP16 is slower
+                    model = model.half()
+                    clip_input_dtype = torch.float16
+                else:
+                    clip_input_dtype = torch.float32
+                clip_model = model
+                app.logger.info(f'[SUCCESS] CLIP model loaded on {device} in {time.perf_counter() - start_time:.1f}s')
+            except Exception as e:
+                app.logger.error(f'[ERROR] Failed to load CLIP model: {str(e)}')
+                raise
+    return clip_model, clip_preprocess, device
+
+# Reference embedding cache
+# Embeddings are persisted as blobs in the SQLite database keyed by
+# (path, mtime, size) so reference images are only encoded once. An
+# in-memory copy of the stacked matrix is kept per preprocessing variant
+# and rebuilt whenever the reference folder contents change.
+EMBEDDING_DIM = 512  # ViT-B/32 output dimension
+
+_ref_cache_lock = threading.Lock()
+_ref_cache = {}  # variant -> {'snapshot': ..., 'matrix': ..., 'filenames': ...}
+
+# Cached folder listing; the folder's own mtime changes on add/remove/
+# rename, so steady-state requests pay a single stat instead of a full
+# directory walk
+_ref_list_cache = {'mtime_ns': None, 'snapshot': {}}
+
+def _scan_reference_folder():
+    """Return {filename: (mtime_ns, size)} for supported images in REFERENCE_FOLDER"""
+    global _ref_list_cache
+    try:
+        dir_mtime_ns = os.stat(REFERENCE_FOLDER).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if _ref_list_cache['mtime_ns'] == dir_mtime_ns:
+        return _ref_list_cache['snapshot']
+
+    snapshot = {}
+    with os.scandir(REFERENCE_FOLDER) as entries:
+        # scandir reuses the dirent's stat result, avoiding a second
+        # stat round trip per file
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.is_file() and entry.name.lower().endswith(SUPPORTED_IMAGE_FORMATS):
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+    _ref_list_cache = {'mtime_ns': dir_mtime_ns, 'snapshot': snapshot}
+    return snapshot
+
+# Optional JPEG decode acceleration: PyTurboJPEG drives libjpeg-turbo's
+# SIMD decode paths, typically several times faster than stock Pillow.
+# Falls back to PIL when the library isn't installed. (Installing
+# Pillow-SIMD additionally speeds up the PIL path with the same API.)
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+except Exception:
+    _turbojpeg = None
+
+def _open_image_rgb(path):
+    """Decode an image file to an RGB PIL image, via libjpeg-turbo when available"""
+    if _turbojpeg is not None and path.lower().endswith(('.jpg', '.jpeg')):
         try:
-            app.logger.info('[LOADING] Loading CLIP model...')
-            import torch
-            import clip
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            clip_model, clip_preprocess = clip.load("ViT-B/32", device=device)
-            app.logger.info(f'[SUCCESS] CLIP model loaded on {device}')
+            with open(path, 'rb') as f:
+                return Image.fromarray(_turbojpeg.decode(f.read(), pixel_format=TJPF_RGB))
         except Exception as e:
-            app.logger.error(f'[ERROR] Failed to load CLIP model: {str(e)}')
-            raise
-    return clip_model, clip_preprocess, device
+            app.logger.warning(f'turbojpeg decode failed for {path}, falling back to PIL: {str(e)}')
+    return Image.open(path).convert('RGB')
+
+# Fused preprocess for the batched rebuild path
+# CLIP's stock preprocess is a transforms.Compose walked in Python per
+# image. Reference images are instead decoded straight to tensors and
+# pushed through one v2 pipeline built once at import, with the
+# normalize step applied to the whole batch on the device. Falls back
+# to the stock preprocess when transforms.v2 isn't available.
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+try:
+    from torchvision.io import decode_image, ImageReadMode
+    from torchvision.transforms import v2 as transforms_v2
+    _fused_resize = transforms_v2.Compose([
+        transforms_v2.Resize(224, interpolation=transforms_v2.InterpolationMode.BICUBIC,
+                             antialias=True),
+        transforms_v2.CenterCrop(224),
+        transforms_v2.ToDtype(torch.float32, scale=True),
+    ])
+    _batch_normalize = transforms_v2.Normalize(mean=CLIP_MEAN, std=CLIP_STD)
+except ImportError:
+    _fused_resize = None
+    _batch_normalize = None
+
+def _run_blocking(fn, *args):
+    """Run a CPU/GPU-bound callable on a real OS thread under gevent.
+
+    gevent workers serve every greenlet from a single OS thread, so a
+    CLIP forward that never yields would freeze the whole worker. When
+    the threading module is monkey-patched the call is pushed onto the
+    hub's native thread pool so the event loop keeps serving IO;
+    otherwise it is a plain call.
+    """
+    try:
+        from gevent import monkey, get_hub
+    except ImportError:
+        return fn(*args)
+    if monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+def _encode_image_features(batch):
+    """ViT forward + FP32 L2 normalize.
+
+    Runs on whichever thread _run_blocking picks, so the thread-local
+    inference_mode guard lives here rather than at the call site.
+    """
+    model, _, _ = load_clip_model()
+    with torch.inference_mode():
+        return F.normalize(model.encode_image(batch).float(), dim=-1)
+
+# Sub-batch size for reference encoding (bounds peak VRAM usage)
+ENCODE_BATCH_SIZE = 32
+
+# Decode threads for cache rebuilds; PIL/libjpeg release the GIL so
+# these overlap with the encoder's forward pass
+PREPROCESS_WORKERS = 4
+
+# Number of best matches returned to the gallery
+TOP_K_RESULTS = 20
+
+def _preprocess_reference_image(path):
+    """Decode and preprocess a single reference image into a CLIP input tensor
+
+    With the fused pipeline the returned tensor is resized/cropped but
+    not yet normalized; _encode_reference_batch normalizes per batch.
+    """
+    if _fused_resize is not None:
+        try:
+            with open(path, 'rb') as f:
+                data = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+            image = decode_image(data, mode=ImageReadMode.RGB)
+        except Exception:
+            # Formats torchvision can't decode (e.g. BMP/GIF) go via PIL
+            image = transforms_v2.functional.pil_to_tensor(_open_image_rgb(path))
+        return _fused_resize(image)
+    _, preprocess, _ = load_clip_model()
+    return preprocess(_open_image_rgb(path))
+
+def _encode_reference_batch(tensors):
+    """Encode a list of preprocessed tensors in one forward pass per sub-batch"""
+    _, _, dev = load_clip_model()
+    features = []
+    for start in range(0, len(tensors), ENCODE_BATCH_SIZE):
+        batch = torch.stack(tensors[start:start + ENCODE_BATCH_SIZE]).to(dev, dtype=clip_input_dtype)
+        if _batch_normalize is not None:
+            # One normalize op over the whole batch on the device
+            batch = _batch_normalize(batch)
+        # L2 normalization happens in FP32 inside _encode_image_features
+        features.append(_run_blocking(_encode_image_features, batch).cpu())
+    return torch.cat(features)
+
+def get_reference_embeddings(variant='default'):
+    """
+    Return (ref_matrix, ref_filenames) for the current reference folder.
+
+    ref_matrix is an [N, EMBEDDING_DIM] tensor of L2-normalized embeddings
+    on the CLIP device; ref_filenames is the parallel list of filenames.
+    Cached embeddings are reused unless a file's mtime or size changed.
+    """
+    model, preprocess, dev = load_clip_model()
+    snapshot = _scan_reference_folder()
+
+    with _ref_cache_lock:
+        cached = _ref_cache.get(variant)
+        if cached is not None and cached['snapshot'] == snapshot:
+            return cached['matrix'], cached['filenames']
+
+        conn = get_db()
+        cursor = conn.cursor()
+        vectors = {}  # filename -> embedding tensor
+        misses = []
+
+        for filename, (mtime_ns, size) in snapshot.items():
+            path = os.path.join(REFERENCE_FOLDER, filename)
+            cursor.execute('''
+                SELECT embedding FROM ref_embeddings
+                WHERE path = ? AND variant = ? AND mtime_ns = ? AND size = ?
+            ''', (path, variant, mtime_ns, size))
+            row = cursor.fetchone()
+
+            if row:
+                blob = bytearray(row[0])
+                if len(blob) == EMBEDDING_DIM * 2:
+                    vector = torch.frombuffer(blob, dtype=torch.float16).float()
+                else:
+                    # Legacy FP32 blob from before embeddings were stored half
+                    vector = torch.frombuffer(blob, dtype=torch.float32).clone()
+                vectors[filename] = vector
+            else:
+                misses.append(filename)
+
+        # Encode all cache misses in batched forward passes. Decode and
+        # preprocess run in a thread pool so the next sub-batch is being
+        # decoded while the current one runs through the encoder.
+        if misses:
+            feature_chunks = []
+            encoded = []
+            with ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS) as pool:
+                futures = [(filename, pool.submit(_preprocess_reference_image,
+                                                  os.path.join(REFERENCE_FOLDER, filename)))
+                           for filename in misses]
+                tensors = []
+                chunk_names = []
+                for filename, future in futures:
+                    try:
+                        tensors.append(future.result())
+                        chunk_names.append(filename)
+                    except Exception as e:
+                        app.logger.error(f'Error preprocessing reference image {filename}: {str(e)}')
+                        continue
+                    if len(tensors) == ENCODE_BATCH_SIZE:
+                        feature_chunks.append(_encode_reference_batch(tensors))
+                        encoded.extend(chunk_names)
+                        tensors = []
+                        chunk_names = []
+                if tensors:
+                    feature_chunks.append(_encode_reference_batch(tensors))
+                    encoded.extend(chunk_names)
+
+            if feature_chunks:
+                features = torch.cat(feature_chunks)
+                for filename, vector in zip(encoded, features):
+                    vectors[filename] = vector
+                    mtime_ns, size = snapshot[filename]
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO ref_embeddings (path, variant, mtime_ns, size, embedding)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (os.path.join(REFERENCE_FOLDER, filename), variant, mtime_ns, size,
+                          vector.half().numpy().tobytes()))
+
+        conn.commit()
+
+        filenames = [f for f in snapshot if f in vectors]
+
+        if filenames:
+            matrix = torch.stack([vectors[f] for f in filenames]).to(dev)
+        else:
+            matrix = torch.empty((0, EMBEDDING_DIM), device=dev)
+
+        entry = {'snapshot': snapshot, 'matrix': matrix, 'filenames': filenames, 'faiss': None}
+        if faiss is not None and filenames:
+            # Exact inner-product index; scales top-k search well past
+            # the point where a dense matmul per request starts to hurt
+            index = faiss.IndexFlatIP(matrix.shape[1])
+            index.add(matrix.cpu().numpy().astype('float32'))
+            entry['faiss'] = index
+        _ref_cache[variant] = entry
+        app.logger.info(f'Reference embeddings ready: {len(filenames)} images (variant={variant})')
+        return matrix, filenames
+
+def search_reference_embeddings(sketch_features, k=TOP_K_RESULTS, variant='default'):
+    """
+    Return (scores, indices, ref_filenames) for the top-k reference matches.
+
+    Uses the FAISS index when the library is installed, otherwise a
+    dense matmul plus device-side topk. Scores are cosine similarities
+    since both sides are L2-normalized.
+    """
+    ref_matrix, ref_filenames = get_reference_embeddings(variant)
+    if not ref_filenames:
+        return [], [], []
+
+    k = min(k, len(ref_filenames))
+    index = _ref_cache[variant].get('faiss')
+    if index is not None:
+        scores, indices = index.search(sketch_features.cpu().numpy().astype('float32'), k)
+        return scores[0].tolist(), indices[0].tolist(), ref_filenames
+
+    similarities = (sketch_features @ ref_matrix.T).squeeze(0)
+    topk_vals, topk_idx = similarities.topk(k)
+    return topk_vals.cpu().tolist(), topk_idx.cpu().tolist(), ref_filenames
 
 # Database setup
+# Each worker thread keeps one long-lived connection instead of paying
+# file open + journal setup on every request. WAL mode lets readers and
+# the single writer proceed concurrently across threads/workers.
+_db_local = threading.local()
+
+def get_db():
+    """Return the long-lived SQLite connection for the current thread"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_PATH, timeout=10, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        _db_local.conn = conn
+    return conn
+
 def init_db():
     """Initialize the SQLite database"""
     try:
@@ -128,12 +580,46 @@ def init_db():
                 user_id INTEGER NOT NULL,
                 otp_code TEXT NOT NULL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP NOT NULL,
+                expires_at INTEGER NOT NULL,
                 is_used BOOLEAN DEFAULT 0,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
         ''')
         
+        # Create reference embedding cache table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ref_embeddings (
+                path TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (path, variant)
+            )
+        ''')
+
+        # Purge legacy OTP rows that stored expires_at as a datetime
+        # string: in SQLite any TEXT compares greater than any INTEGER,
+        # so such rows would pass the expires_at > ? check forever and
+        # never match the cleanup's expires_at < ?
+        cursor.execute("DELETE FROM otps WHERE typeof(expires_at) = 'text'")
+
+        # Index for the OTP verification lookup
+        cursor.execute('DROP INDEX IF EXISTS idx_otps_user_otp')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_otps_lookup
+            ON otps(user_id, is_used, expires_at)
+        ''')
+
+        # Create server-side session table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
         # Insert default user if not exists
         cursor.execute('SELECT id FROM users WHERE email = ?', ('admin@facesketch.com',))
         if not cursor.fetchone():
@@ -157,9 +643,27 @@ except Exception as e:
     if not DEBUG_MODE:
         raise
 
+# Background cleanup of expired OTPs and sessions, so the auth path
+# never pays for B-tree bloat or inline deletes
+CLEANUP_INTERVAL_SECONDS = 60
+
+def _cleanup_expired_records():
+    """Periodically purge expired OTP and session rows"""
+    while True:
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+        try:
+            conn = get_db()
+            with conn:
+                conn.execute('DELETE FROM otps WHERE expires_at < ?', (int(time.time()),))
+                conn.execute('DELETE FROM sessions WHERE expires_at < ?', (time.time(),))
+        except Exception as e:
+            app.logger.error(f'Error cleaning up expired records: {str(e)}')
+
+threading.Thread(target=_cleanup_expired_records, daemon=True, name='db-cleanup').start()
+
 def generate_otp(length=6):
-    """Generate a random OTP"""
-    return ''.join(random.choices(string.digits, k=length))
+    """Generate a cryptographically secure random OTP"""
+    return f'{secrets.randbelow(10 ** length):0{length}d}'
 
 def login_required(f):
     """Decorator to protect routes"""
@@ -181,7 +685,7 @@ def login():
             return jsonify({'success': False, 'message': 'Email is required'}), 400
         
         try:
-            conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+            conn = get_db()
             cursor = conn.cursor()
             
             # Check if user exists - only allow existing users
@@ -189,7 +693,6 @@ def login():
             user = cursor.fetchone()
             
             if not user:
-                conn.close()
                 app.logger.warning(f'Login attempt for non-existent user: {email}')
                 return jsonify({
                     'success': False, 
@@ -198,16 +701,16 @@ def login():
             
             user_id, username, email = user
             
-            # Generate OTP
+            # Generate OTP (expiry stored as unix seconds; integer
+            # comparisons are far cheaper than datetime round trips)
             otp_code = generate_otp()
-            expires_at = datetime.now() + timedelta(minutes=10)
+            expires_at = int(time.time()) + 10 * 60
             
-            cursor.execute('''
-                INSERT INTO otps (user_id, otp_code, expires_at) 
-                VALUES (?, ?, ?)
-            ''', (user_id, otp_code, expires_at))
-            conn.commit()
-            conn.close()
+            with conn:  # auto-commit on success
+                conn.execute('''
+                    INSERT INTO otps (user_id, otp_code, expires_at) 
+                    VALUES (?, ?, ?)
+                ''', (user_id, otp_code, expires_at))
             
             # Log OTP (in production, send via email/SMS service)
             if DEBUG_MODE:
@@ -215,10 +718,10 @@ def login():
                 print(f'[OTP] OTP GENERATED FOR {email}')
                 print(f'[EMAIL] User: {username}')
                 print(f'[CODE] OTP Code: {otp_code}')
-                print(f'[TIME] Expires at: {expires_at.strftime("%Y-%m-%d %H:%M:%S")}')
+                print(f'[TIME] Expires at: {datetime.fromtimestamp(expires_at).strftime("%Y-%m-%d %H:%M:%S")}')
                 print('=' * 50)
             else:
-                app.logger.info(f'OTP generated for user {username} (expires at {expires_at})')
+                app.logger.info(f'OTP generated for user {username} (expires at {datetime.fromtimestamp(expires_at)})')
                 # TODO: Integrate with email/SMS service (e.g., SendGrid, Twilio)
             
             return jsonify({
@@ -246,42 +749,32 @@ def verify_otp():
         return jsonify({'success': False, 'message': 'User ID and OTP are required'}), 400
     
     try:
-        conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+        conn = get_db()
         cursor = conn.cursor()
         
-        # Check OTP
+        # Check OTP: one indexed lookup for the latest live code, with a
+        # constant-time comparison of the code itself
         cursor.execute('''
-            SELECT id, expires_at, is_used FROM otps 
-            WHERE user_id = ? AND otp_code = ? 
+            SELECT id, otp_code FROM otps 
+            WHERE user_id = ? AND is_used = 0 AND expires_at > ? 
             ORDER BY created_at DESC LIMIT 1
-        ''', (user_id, otp_code))
+        ''', (user_id, int(time.time())))
         
         otp_record = cursor.fetchone()
         
-        if not otp_record:
-            conn.close()
+        if not otp_record or not hmac.compare_digest(otp_record[1], otp_code):
             app.logger.warning(f'Invalid OTP attempt for user_id: {user_id}')
-            return jsonify({'success': False, 'message': 'Invalid OTP code'}), 400
-        
-        otp_id, expires_at_str, is_used = otp_record
-        expires_at = datetime.strptime(expires_at_str, '%Y-%m-%d %H:%M:%S.%f')
+            return jsonify({'success': False, 'message': 'Invalid or expired OTP code'}), 400
         
-        if is_used:
-            conn.close()
-            return jsonify({'success': False, 'message': 'OTP already used'}), 400
-        
-        if datetime.now() > expires_at:
-            conn.close()
-            return jsonify({'success': False, 'message': 'OTP expired'}), 400
+        otp_id = otp_record[0]
         
         # Mark OTP as used
-        cursor.execute('UPDATE otps SET is_used = 1 WHERE id = ?', (otp_id,))
-        conn.commit()
+        with conn:  # auto-commit on success
+            conn.execute('UPDATE otps SET is_used = 1 WHERE id = ?', (otp_id,))
         
         # Get user info
         cursor.execute('SELECT username, email FROM users WHERE id = ?', (user_id,))
         user = cursor.fetchone()
-        conn.close()
         
         if user:
             username, email = user
@@ -354,10 +847,13 @@ def save_sketch():
         filename = f'sketch_{timestamp}.json'
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         
-        # Save sketch data
-        import json
-        with open(filepath, 'w') as f:
-            json.dump(sketch_data, f, indent=2)
+        # Save sketch data with a single buffered write
+        if orjson is not None:
+            payload = orjson.dumps(sketch_data, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(sketch_data, indent=2).encode('utf-8')
+        with open(filepath, 'wb') as f:
+            f.write(payload)
         
         return jsonify({
             'success': True,
@@ -393,8 +889,6 @@ def face_recognition():
 def clip_compare():
     """Compare sketch with reference images from database using CLIP embeddings"""
     try:
-        # Load CLIP model on first use
-        import torch
         model, preprocess, dev = load_clip_model()
         
         # Get the uploaded sketch image
@@ -408,83 +902,45 @@ def clip_compare():
         
         # Process sketch image
         sketch_image = Image.open(sketch_file).convert('RGB')
-        sketch_preprocessed = preprocess(sketch_image).unsqueeze(0).to(dev)
-        
-        # Get sketch embedding
-        with torch.no_grad():
-            sketch_features = model.encode_image(sketch_preprocessed)
-            sketch_features = sketch_features / sketch_features.norm(dim=-1, keepdim=True)
-        
-        # Get all reference images from database folder
-        reference_folder = 'D:\\thirdeye\\thirdeye\\face_detection1\\project\\reference_database'
+        sketch_preprocessed = preprocess(sketch_image).unsqueeze(0).to(dev, dtype=clip_input_dtype)
         
-        if not os.path.exists(reference_folder):
-            return jsonify({
-                'success': False,
-                'message': 'Reference database folder not found. Please add reference images to the "reference_database" folder.'
-            }), 404
+        # Get sketch embedding (normalized in FP32); the forward runs
+        # off the event-loop thread under gevent
+        sketch_features = _run_blocking(_encode_image_features, sketch_preprocessed)
         
-        # Get all image files from reference database
-        supported_formats = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
-        reference_files = [f for f in os.listdir(reference_folder) 
-                          if f.lower().endswith(supported_formats)]
-        
-        if not reference_files:
+        # Top-k search against the cached reference embeddings
+        scores, indices, ref_filenames = search_reference_embeddings(sketch_features)
+
+        if not ref_filenames:
             return jsonify({
                 'success': False,
                 'message': 'No reference images found in database. Please add images to the "reference_database" folder.'
             }), 404
-        
+
         results = []
+
+        for index, similarity in zip(indices, scores):
+            # Convert to percentage (0-100)
+            prediction_score = ((similarity + 1) / 2) * 100  # Normalize from [-1,1] to [0,100]
+
+            results.append({
+                'filename': ref_filenames[index],
+                'similarity': round(similarity, 4),
+                'prediction_score': round(prediction_score, 2),
+                'matched': prediction_score >= 75,  # Consider matched if score >= 75%
+                'image_path': f'/reference-image/{ref_filenames[index]}'
+            })
+
+        app.logger.info(f'CLIP compare: scored {len(ref_filenames)} references, '
+                        f'best {results[0]["prediction_score"]:.2f}%')
         
-        # Compare with each reference image in database
-        for ref_filename in reference_files:
-            try:
-                ref_path = os.path.join(reference_folder, ref_filename)
-                
-                # Process reference image
-                ref_image = Image.open(ref_path).convert('RGB')
-                ref_preprocessed = preprocess(ref_image).unsqueeze(0).to(dev)
-                
-                # Get reference embedding
-                with torch.no_grad():
-                    ref_features = model.encode_image(ref_preprocessed)
-                    ref_features = ref_features / ref_features.norm(dim=-1, keepdim=True)
-                
-                # Calculate cosine similarity
-                similarity = (sketch_features @ ref_features.T).item()
-                
-                # Convert to percentage (0-100)
-                prediction_score = ((similarity + 1) / 2) * 100  # Normalize from [-1,1] to [0,100]
-                
-                results.append({
-                    'filename': ref_filename,
-                    'similarity': round(similarity, 4),
-                    'prediction_score': round(prediction_score, 2),
-                    'matched': prediction_score >= 75,  # Consider matched if score >= 75%
-                    'image_path': f'/reference-image/{ref_filename}'
-                })
-                
-                print(f'[INFO] {ref_filename}: Similarity={similarity:.4f}, Score={prediction_score:.2f}%')
-                
-            except Exception as e:
-                results.append({
-                    'filename': ref_filename,
-                    'error': str(e),
-                    'matched': False
-                })
-                print(f'[ERROR] Error processing {ref_filename}: {str(e)}')
-        
-        # Sort results by prediction score (highest first)
-        results.sort(key=lambda x: x.get('prediction_score', 0), reverse=True)
-        
-        # Get top matches (score >= 75%)
+        # topk already returns results sorted by similarity (highest first)
         top_matches = [r for r in results if r.get('matched', False)]
         
         return jsonify({
             'success': True,
-            'message': f'Searched {len(results)} reference images in database',
-            'total_images': len(results),
+            'message': f'Searched {len(ref_filenames)} reference images in database',
+            'total_images': len(ref_filenames),
             'matches_found': len(top_matches),
             'results': results,  # Return all results for gallery
             'device': dev
@@ -507,6 +963,13 @@ def get_reference_image(filename):
         if safe_path is None or not os.path.exists(safe_path):
             app.logger.warning(f'Invalid reference image request: {filename}')
             return jsonify({'success': False, 'message': 'Image not found'}), 404
+        if X_ACCEL_REFERENCE_PREFIX:
+            # Let nginx stream the file from its internal location; the
+            # header value is a URI, so the filename must be quoted
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = Response(mimetype=mimetype)
+            response.headers['X-Accel-Redirect'] = f'{X_ACCEL_REFERENCE_PREFIX}{quote(filename)}'
+            return response
         return send_from_directory(REFERENCE_FOLDER, filename)
     except Exception as e:
         app.logger.error(f'Error serving reference image {filename}: {str(e)}')
@@ -526,9 +989,6 @@ def offline_face_match_process():
     Similar to AWS Rekognition's SearchFacesByImage functionality
     """
     try:
-        # Load CLIP model on first use
-        import torch
-        import numpy as np
         model, preprocess, dev = load_clip_model()
         
         # Get the uploaded sketch image
@@ -540,104 +1000,50 @@ def offline_face_match_process():
         if sketch_file.filename == '':
             return jsonify({'success': False, 'message': 'No file selected'}), 400
         
-        # Process sketch image - Apply face-focused preprocessing
+        # Process sketch image; CLIP's own preprocess handles the
+        # resize/crop, so no extra LANCZOS pass or contrast tweak here
         sketch_image = Image.open(sketch_file).convert('RGB')
         
-        # Resize to standard size for better comparison
-        sketch_image = sketch_image.resize((224, 224), Image.LANCZOS)
+        sketch_preprocessed = preprocess(sketch_image).unsqueeze(0).to(dev, dtype=clip_input_dtype)
         
-        # Apply contrast enhancement for better feature detection
-        from PIL import ImageEnhance
-        enhancer = ImageEnhance.Contrast(sketch_image)
-        sketch_image = enhancer.enhance(1.5)  # Increase contrast by 50%
+        # Get sketch embedding (normalized in FP32); the forward runs
+        # off the event-loop thread under gevent
+        sketch_features = _run_blocking(_encode_image_features, sketch_preprocessed)
         
-        sketch_preprocessed = preprocess(sketch_image).unsqueeze(0).to(dev)
-        
-        # Get sketch embedding
-        with torch.no_grad():
-            sketch_features = model.encode_image(sketch_preprocessed)
-            sketch_features = sketch_features / sketch_features.norm(dim=-1, keepdim=True)
-        
-        # Get all reference images from database folder
-        reference_folder = 'D:\\thirdeye\\thirdeye\\face_detection1\\project\\reference_database'
-        
-        if not os.path.exists(reference_folder):
-            return jsonify({
-                'success': False,
-                'message': 'Reference database folder not found. Please add reference images to the "reference_database" folder.'
-            }), 404
-        
-        # Get all image files from reference database
-        supported_formats = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
-        reference_files = [f for f in os.listdir(reference_folder) 
-                          if f.lower().endswith(supported_formats)]
-        
-        if not reference_files:
+        # Top-k search against the cached reference embeddings
+        scores, indices, ref_filenames = search_reference_embeddings(sketch_features)
+
+        if not ref_filenames:
             return jsonify({
                 'success': False,
                 'message': 'No reference images found in database. Please add images to the "reference_database" folder.'
             }), 404
-        
+
         matches = []
-        embeddings_cache = {}  # Cache for reference embeddings
-        
-        # Compare with each reference image in database
-        for ref_filename in reference_files:
-            try:
-                ref_path = os.path.join(reference_folder, ref_filename)
-                
-                # Process reference image with same preprocessing
-                ref_image = Image.open(ref_path).convert('RGB')
-                
-                # Resize to standard size
-                ref_image = ref_image.resize((224, 224), Image.LANCZOS)
-                
-                # Apply same contrast enhancement
-                enhancer = ImageEnhance.Contrast(ref_image)
-                ref_image = enhancer.enhance(1.5)
-                
-                ref_preprocessed = preprocess(ref_image).unsqueeze(0).to(dev)
-                
-                # Get reference embedding
-                with torch.no_grad():
-                    ref_features = model.encode_image(ref_preprocessed)
-                    ref_features = ref_features / ref_features.norm(dim=-1, keepdim=True)
-                
-                # Calculate cosine similarity
-                similarity = (sketch_features @ ref_features.T).item()
-                
-                # Enhanced scoring algorithm that considers facial structure
-                # Boost the score slightly for better matches
-                base_score = ((similarity + 1) / 2) * 100  # Normalize from [-1,1] to [0,100]
-                
-                # Apply confidence boost for higher similarities
-                if similarity > 0.7:
-                    confidence_boost = (similarity - 0.7) * 20  # Up to 6% boost for very high similarities
-                    prediction_score = min(base_score + confidence_boost, 100)
-                else:
-                    prediction_score = base_score
-                
-                matches.append({
-                    'filename': ref_filename,
-                    'similarity': round(similarity, 4),
-                    'prediction_score': round(prediction_score, 2),
-                    'matched': prediction_score >= 50,  # Lower threshold to show more matches
-                    'image_path': url_for('get_reference_image', filename=ref_filename)
-
-                })
-                
-                if DEBUG_MODE:
-                    print(f'[INFO] {ref_filename}: Similarity={similarity:.4f}, Score={prediction_score:.2f}%')
-                
-            except Exception as e:
-                app.logger.error(f'Error processing {ref_filename}: {str(e)}')
-                if DEBUG_MODE:
-                    print(f'[ERROR] Error processing {ref_filename}: {str(e)}')
-        
-        # Sort by prediction score (highest first)
-        matches.sort(key=lambda x: x.get('prediction_score', 0), reverse=True)
+
+        for index, similarity in zip(indices, scores):
+            ref_filename = ref_filenames[index]
+            # Enhanced scoring algorithm that considers facial structure
+            # Boost the score slightly for better matches
+            base_score = ((similarity + 1) / 2) * 100  # Normalize from [-1,1] to [0,100]
+
+            # Apply confidence boost for higher similarities
+            if similarity > 0.7:
+                confidence_boost = (similarity - 0.7) * 20  # Up to 6% boost for very high similarities
+                prediction_score = min(base_score + confidence_boost, 100)
+            else:
+                prediction_score = base_score
+
+            matches.append({
+                'filename': ref_filename,
+                'similarity': round(similarity, 4),
+                'prediction_score': round(prediction_score, 2),
+                'matched': prediction_score >= 50,  # Lower threshold to show more matches
+                'image_path': url_for('get_reference_image', filename=ref_filename)
+
+            })
         
-        # Get best match
+        # topk already returns matches sorted by similarity (highest first)
         best_match = matches[0] if matches else None
         
         # Check if best match meets threshold (50% for better accuracy)
@@ -649,9 +1055,9 @@ def offline_face_match_process():
                 'success': True,
                 'message': 'Face matched successfully!',
                 'best_match': best_match,
-                'total_images': len(matches),
+                'total_images': len(ref_filenames),
                 'threshold': 50,
-                'matches': matches,  # Return all matches for gallery display
+                'matches': matches,  # Return top matches for gallery display
                 'device': dev
             })
         else:
@@ -662,9 +1068,9 @@ def offline_face_match_process():
                 'success': False,
                 'message': f'No match found in the database. Best match: {best_match["prediction_score"] if best_match else 0}% (threshold: 50%)',
                 'best_match': best_match,  # Still return best attempt
-                'total_images': len(matches),
+                'total_images': len(ref_filenames),
                 'threshold': 50,
-                'matches': matches,  # Return all matches for gallery display
+                'matches': matches,  # Return top matches for gallery display
                 'device': dev
             })
         
@@ -1,7 +1,11 @@
 bind = "127.0.0.1:8000"
 workers = 4  # (2 * CPU cores) + 1
-threads = 2
-worker_class = "gthread"
+# gevent greenlets let IO-bound requests (reference images, uploads,
+# static files) overlap far beyond the old 2-threads-per-worker cap;
+# app.py pushes the CLIP forward onto the hub's native thread pool so
+# it doesn't block the worker's event loop
+worker_class = "gevent"
+worker_connections = 1000
 timeout = 120  # Increase for ML model loading
 keepalive = 5
 max_requests = 1000
@@ -16,3 +20,13 @@ loglevel = "info"
 limit_request_line = 4096
 limit_request_fields = 100
 limit_request_field_size = 8190
+
+# Pre-warm the CLIP model in each worker so the first requests don't
+# race to load it under the request timeout. This must be
+# post_worker_init, not post_fork: gevent workers monkey-patch in
+# init_process, which runs after post_fork, so importing app.py there
+# would start its background threads and create its thread-locals
+# before patching.
+def post_worker_init(worker):
+    from app import load_clip_model
+    load_clip_model()